@@ -1,75 +1,218 @@
-from passlib.context import CryptContext
-from jose import JWTError, jwt
-from datetime import datetime, timedelta
-import pyotp
-import qrcode
+import bcrypt
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
 import base64
+import binascii
+import hashlib
+import hmac
+import secrets
+import struct
+import time
+import unicodedata
 from io import BytesIO
-from PIL import Image
+import orjson
+import pybase64
+import pyotp
+import segno
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_MIN_ROUNDS = 12
+BCRYPT_TARGET_SECONDS = 0.25
+BCRYPT_ROUNDS_FILE = "bcrypt_rounds.txt"  # first calibration, kept so the cost doesn't drift between restarts
 
 # JWT settings
 SECRET_KEY = "your-secret-key-change-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# TOTP settings (Google Authenticator defaults)
+TOTP_INTERVAL = 30
+TOTP_DIGITS = 6
+TOTP_SECRET_BYTES = 20
+TOTP_VALID_WINDOW = 1  # accept codes from one step either side to absorb clock drift
+
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+def get_password_hash(password, rounds=BCRYPT_MIN_ROUNDS):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=rounds)).decode()
 
-def create_access_token(data: dict, expires_delta: timedelta = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+def password_hash_rounds(hashed_password):
+    """Cost factor embedded in a bcrypt hash ($2b$NN$...)"""
+    return int(hashed_password.split("$")[2])
+
+def calibrate_bcrypt_rounds(target_seconds: float = BCRYPT_TARGET_SECONDS):
+    """Pick the highest bcrypt cost that hashes within target_seconds on this machine"""
+    rounds = BCRYPT_MIN_ROUNDS
+    start = time.perf_counter()
+    bcrypt.hashpw(b"calibration", bcrypt.gensalt(rounds=rounds))
+    elapsed = time.perf_counter() - start
+    
+    # Each extra round doubles the work
+    while rounds < 31 and elapsed * 2 <= target_seconds:
+        rounds += 1
+        elapsed *= 2
+    return rounds
+
+def load_bcrypt_rounds():
+    """Cost saved by an earlier calibration, or None"""
+    try:
+        with open(BCRYPT_ROUNDS_FILE) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def save_bcrypt_rounds(rounds: int):
+    with open(BCRYPT_ROUNDS_FILE, "w") as f:
+        f.write(str(rounds))
+
+def pin_worker_to_cpu(counter, cpus):
+    """Pool initializer: give each bcrypt process its own CPU so its Blowfish state stays cache-hot"""
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {cpus[index % len(cpus)]})
+
+def claim_worker_slot(slot_dir: str, web_workers: int):
+    """Lock the first free slot file in slot_dir; returns (slot, lock file) or (None, None)"""
+    try:
+        import fcntl
+    except ImportError:
+        return None, None
+    for slot in range(web_workers):
+        lock_file = open(os.path.join(slot_dir, f"slot-{slot}"), "w")
+        try:
+            # Released automatically if this worker dies, so a replacement can take the slot
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        return slot, lock_file
+    return None, None
+
+def create_bcrypt_pool(web_workers: int = 1, slot: int = None):
+    """Process pool for bcrypt work using this web worker's share of the CPUs, pinned when its slot is known"""
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
     else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+        cpus = list(range(os.cpu_count() or 1))
+    size = max(1, len(cpus) // web_workers)
+    if slot is None:
+        return ProcessPoolExecutor(max_workers=size)
+    # Each slot owns its own run of CPUs, so different web workers' pools never share a core
+    return ProcessPoolExecutor(
+        max_workers=size,
+        initializer=pin_worker_to_cpu,
+        initargs=(multiprocessing.Value("i", slot * size), cpus)
+    )
 
-def verify_token(token: str):
+def _b64url(data: bytes):
+    return pybase64.urlsafe_b64encode(data).rstrip(b"=")
+
+def _b64url_decode(data: bytes):
+    return pybase64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+# The key and header never change, so set them up once and copy the keyed HMAC per token
+_TOKEN_HMAC = hmac.new(SECRET_KEY.encode(), digestmod=hashlib.sha256)
+_HEADER_B64 = _b64url(orjson.dumps({"alg": ALGORITHM, "typ": "JWT"}))
+
+def _sign(signing_input: bytes):
+    mac = _TOKEN_HMAC.copy()
+    mac.update(signing_input)
+    return mac.digest()
+
+def create_access_token(data: dict, expires_delta: timedelta = None):
+    lifetime = expires_delta or timedelta(minutes=15)
+    payload = orjson.dumps({**data, "exp": int(time.time() + lifetime.total_seconds())})
+    signing_input = _HEADER_B64 + b"." + _b64url(payload)
+    return (signing_input + b"." + _b64url(_sign(signing_input))).decode()
+
+def decode_token(token: str):
+    """Check the signature and expiry of a token issued by create_access_token"""
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
+        signing_input, _, signature = token.encode("ascii").rpartition(b".")
+        header, _, payload = signing_input.partition(b".")
+        # Only our own fixed header is accepted, which pins the algorithm to HS256
+        if header != _HEADER_B64 or not hmac.compare_digest(_sign(signing_input), _b64url_decode(signature)):
             return None
-        return email
-    except JWTError:
+        claims = orjson.loads(_b64url_decode(payload))
+    except ValueError:
+        return None
+    
+    if not isinstance(claims, dict):
+        return None
+    exp = claims.get("exp")
+    if not isinstance(exp, (int, float)) or exp <= time.time():
+        return None
+    return claims
+
+def verify_token(token: str):
+    payload = decode_token(token)
+    if payload is None:
+        return None
+    email: str = payload.get("sub")
+    if email is None:
         return None
+    return email
 
 def generate_mfa_secret():
-    """Generate a new MFA secret for Google Authenticator"""
-    return pyotp.random_base32()
+    """Generate a new raw MFA secret for Google Authenticator"""
+    return secrets.token_bytes(TOTP_SECRET_BYTES)
 
-def generate_qr_code(email: str, secret: str):
+def encode_mfa_secret(secret: bytes):
+    """Base32 form of a secret, as shown to the user and put in the QR code"""
+    return base64.b32encode(secret).decode()
+
+def decode_mfa_secret(secret: str):
+    """Raw bytes of a base32 secret, or None if it isn't valid base32"""
+    padding = "=" * (-len(secret) % 8)
+    try:
+        return base64.b32decode(secret + padding, casefold=True)
+    except binascii.Error:
+        return None
+
+def generate_qr_code(email: str, secret: bytes):
     """Generate QR code for Google Authenticator"""
-    totp = pyotp.TOTP(secret)
+    totp = pyotp.TOTP(encode_mfa_secret(secret))
     provisioning_uri = totp.provisioning_uri(
         name=email,
         issuer_name="PyOTP App"
     )
     
-    # Create QR code
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(provisioning_uri)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    # Convert PIL image to PNG format
-    img = img.convert('RGB')
-    
-    # Convert to base64
+    # Write the PNG directly (no PIL image round-trip)
+    qr = segno.make(provisioning_uri, error="m")
     buffer = BytesIO()
-    img.save(buffer, format='PNG')
-    img_str = base64.b64encode(buffer.getvalue()).decode()
+    qr.save(buffer, kind="png", scale=10, border=5)
+    
+    # Convert to base64 (pybase64 uses SIMD encoders where available)
+    img_str = pybase64.b64encode_as_string(buffer.getvalue())
     
     return f"data:image/png;base64,{img_str}"
 
-def verify_mfa_code(secret: str, code: str):
+@lru_cache(maxsize=4096)
+def _totp_hmac(secret: bytes):
+    """HMAC-SHA1 keyed with the secret, copied for every code"""
+    return hmac.new(secret, digestmod=hashlib.sha1)
+
+def _totp_code(secret: bytes, counter: int):
+    mac = _totp_hmac(secret).copy()
+    mac.update(struct.pack(">Q", counter))
+    digest = mac.digest()
+    offset = digest[-1] & 0x0F
+    code = struct.unpack(">I", digest[offset:offset + 4])[0] & 0x7FFFFFFF
+    return str(code % 10 ** TOTP_DIGITS).zfill(TOTP_DIGITS)
+
+def verify_mfa_code(secret: bytes, code: str):
     """Verify MFA code from Google Authenticator"""
-    totp = pyotp.TOTP(secret)
-    return totp.verify(code)
+    counter = int(time.time()) // TOTP_INTERVAL
+    # NFKC folds full-width digits from mobile keyboards to ASCII, as pyotp did
+    code = unicodedata.normalize("NFKC", code).encode()
+    # Check every step in the window (no early exit) so timing doesn't leak which matched
+    valid = False
+    for step in range(-TOTP_VALID_WINDOW, TOTP_VALID_WINDOW + 1):
+        valid |= hmac.compare_digest(_totp_code(secret, counter + step).encode(), code)
+    return valid
@@ -0,0 +1,98 @@
+import os
+import time
+from hashlib import blake2b
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from auth import decode_token, generate_mfa_secret, encode_mfa_secret, generate_qr_code
+from database import get_user_row_by_email, normalize_email
+from models import CachedUser, MFASetup
+
+# Redis connection (caching is disabled when REDIS_URL is not set)
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
+USER_CACHE_TTL = 300
+MFA_SETUP_TTL = 600
+
+async def cache_get(key: str):
+    """Read a cached value, treating Redis errors as a cache miss"""
+    if redis_client is None:
+        return None
+    try:
+        return await redis_client.get(key)
+    except RedisError:
+        return None
+
+async def cache_set(key: str, value: str, ttl: int):
+    """Store a value with an expiry in seconds"""
+    if redis_client is None:
+        return
+    try:
+        await redis_client.set(key, value, ex=ttl)
+    except RedisError:
+        pass
+
+async def cache_delete(key: str):
+    """Remove a cached value"""
+    if redis_client is None:
+        return
+    try:
+        await redis_client.delete(key)
+    except RedisError:
+        pass
+
+async def verify_token_cached(token: str):
+    """Verify a JWT, caching its subject for the token's remaining lifetime"""
+    key = "jwt:" + blake2b(token.encode(), digest_size=16).hexdigest()
+    email = await cache_get(key)
+    if email:
+        return email
+    
+    payload = decode_token(token)
+    if payload is None:
+        return None
+    email = payload.get("sub")
+    if email is None:
+        return None
+    
+    ttl = int(payload["exp"] - time.time())
+    if ttl > 0:
+        await cache_set(key, email, ttl)
+    return email
+
+async def get_user_cached(db: AsyncSession, email: str):
+    """Look up a user by email, reading through the Redis cache"""
+    key = f"user:{normalize_email(email)}"
+    cached = await cache_get(key)
+    if cached:
+        return CachedUser.model_validate_json(cached)
+    
+    row = await get_user_row_by_email(db, email)
+    if row is None:
+        return None
+    
+    cached_user = CachedUser.model_validate(row)
+    await cache_set(key, cached_user.model_dump_json(), USER_CACHE_TTL)
+    return cached_user
+
+async def invalidate_user(email: str):
+    """Drop a cached user after its row changes"""
+    await cache_delete(f"user:{normalize_email(email)}")
+
+async def get_mfa_setup_cached(email: str):
+    """Get the pending MFA secret and QR code, reusing them across page reloads"""
+    key = f"mfa_setup:{normalize_email(email)}"
+    cached = await cache_get(key)
+    if cached:
+        return MFASetup.model_validate_json(cached)
+    
+    secret = generate_mfa_secret()
+    setup = MFASetup(secret=encode_mfa_secret(secret), qr_code=generate_qr_code(email, secret))
+    await cache_set(key, setup.model_dump_json(), MFA_SETUP_TTL)
+    return setup
+
+async def clear_mfa_setup(email: str):
+    """Forget the pending MFA setup once it has been confirmed"""
+    await cache_delete(f"mfa_setup:{normalize_email(email)}")
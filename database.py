@@ -1,13 +1,29 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, LargeBinary, Index, func, select, bindparam, inspect, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 from datetime import datetime
+import os
 
-# Create SQLite database
-SQLALCHEMY_DATABASE_URL = "sqlite:///./users.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+from auth import decode_mfa_secret
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Use SQLite (aiosqlite) unless DATABASE_URL points at PostgreSQL (postgresql+asyncpg://...).
+# asyncpg keeps an LRU of prepared statements per connection, so the hot lookups skip parse/plan.
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./users.db")
+if SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+    engine = create_async_engine(SQLALCHEMY_DATABASE_URL)
+else:
+    # 20 (+40 overflow) connections in total, split between the web workers
+    web_workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    engine = create_async_engine(
+        SQLALCHEMY_DATABASE_URL,
+        pool_size=max(1, 20 // web_workers),
+        max_overflow=max(0, 40 // web_workers),
+        pool_pre_ping=True
+    )
+
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 class User(Base):
@@ -17,16 +33,84 @@ class User(Base):
     email = Column(String, unique=True, index=True)
     name = Column(String)
     hashed_password = Column(String)
-    mfa_secret = Column(String, nullable=True)
+    mfa_secret = Column(LargeBinary(20), nullable=True)
     mfa_enabled = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+    __table_args__ = (Index("ix_users_email_lower", func.lower(email)),)
+
+# Case-insensitive lookups served by ix_users_email_lower
+USER_BY_EMAIL = select(User).where(func.lower(User.email) == bindparam("email"))
+
+# Plain column rows for read-only paths (no identity map or attribute instrumentation)
+USER_ROW_BY_EMAIL = select(
+    User.id, User.email, User.name, User.hashed_password,
+    User.mfa_secret, User.mfa_enabled, User.created_at
+).where(func.lower(User.email) == bindparam("email"))
+
+def _create_schema(sync_conn):
+    Base.metadata.create_all(sync_conn)
+    # create_all skips tables that already exist, so add indexes introduced later explicitly
+    # (IF NOT EXISTS rather than checkfirst: SQLite can't reflect expression indexes)
+    for index in User.__table__.indexes:
+        sync_conn.execute(CreateIndex(index, if_not_exists=True))
+
+async def _create_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(_create_schema)
+
+def _mfa_secret_is_text(sync_conn):
+    columns = {column["name"]: column["type"] for column in inspect(sync_conn).get_columns("users")}
+    return not isinstance(columns["mfa_secret"], LargeBinary)
 
-def get_db():
-    db = SessionLocal()
+async def _migrate_mfa_secrets(conn):
+    """Convert the base32 text secrets stored by older versions into raw bytes"""
+    if conn.dialect.name == "sqlite":
+        # SQLite keeps the old declared column type, so find the values still stored as text
+        rows = (await conn.execute(text("SELECT id, mfa_secret FROM users WHERE typeof(mfa_secret) = 'text'"))).all()
+    else:
+        if not await conn.run_sync(_mfa_secret_is_text):
+            return
+        if conn.dialect.name == "postgresql":
+            # Lock only when a conversion is needed, then re-check in case another worker just finished it
+            await conn.execute(text("LOCK TABLE users IN ACCESS EXCLUSIVE MODE"))
+            if not await conn.run_sync(_mfa_secret_is_text):
+                return
+        
+        rows = (await conn.execute(text("SELECT id, mfa_secret FROM users WHERE mfa_secret IS NOT NULL"))).all()
+        if conn.dialect.name == "postgresql":
+            # PostgreSQL needs the column retyped (values are rewritten below)
+            await conn.execute(text("ALTER TABLE users ALTER COLUMN mfa_secret TYPE bytea USING NULL"))
+    
+    updates = []
+    for user_id, secret in rows:
+        if isinstance(secret, str) and (secret_bytes := decode_mfa_secret(secret)) is not None:
+            updates.append({"user_id": user_id, "secret": secret_bytes})
+    if updates:
+        statement = User.__table__.update().where(User.id == bindparam("user_id")).values(mfa_secret=bindparam("secret"))
+        await conn.execute(statement, updates)
+
+async def init_db():
+    """Create tables and migrate old data; safe to run from several processes at once"""
     try:
+        await _create_tables()
+    except DBAPIError:
+        # Another process created a table between our existence check and CREATE TABLE;
+        # the second pass sees it and skips it
+        await _create_tables()
+    
+    async with engine.begin() as conn:
+        await _migrate_mfa_secrets(conn)
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+def normalize_email(email: str):
+    return email.strip().lower()
+
+async def get_user_by_email(db, email: str):
+    return (await db.scalars(USER_BY_EMAIL, {"email": normalize_email(email)})).first()
+
+async def get_user_row_by_email(db, email: str):
+    return (await db.execute(USER_ROW_BY_EMAIL, {"email": normalize_email(email)})).first()
@@ -1,22 +1,97 @@
 from fastapi import FastAPI, Depends, HTTPException, status, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, ORJSONResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.utils import is_body_allowed_for_status_code
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from jinja2 import FileSystemBytecodeCache
 from typing import Optional
+from contextlib import asynccontextmanager
+from hashlib import blake2b
+import asyncio
 import os
+import tempfile
 
-from database import get_db, User
+from database import engine, init_db, get_db, get_user_by_email, normalize_email, User
 from auth import (
-    get_password_hash, verify_password, create_access_token, 
-    verify_token, generate_mfa_secret, generate_qr_code, verify_mfa_code
+    get_password_hash, verify_password, create_access_token, verify_mfa_code, decode_mfa_secret,
+    password_hash_rounds, BCRYPT_MIN_ROUNDS, calibrate_bcrypt_rounds, load_bcrypt_rounds, save_bcrypt_rounds,
+    claim_worker_slot, create_bcrypt_pool
+)
+from cache import (
+    verify_token_cached, get_user_cached, invalidate_user,
+    get_mfa_setup_cached, clear_mfa_setup
 )
 from models import UserCreate, UserLogin, MFAVerify, Token, MFASetup
 
-app = FastAPI(title="PyOTP App", description="Simple MFA application")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The launcher below creates the schema once; plain `uvicorn main:app` creates it per worker
+    if not os.getenv("DB_SCHEMA_READY"):
+        await init_db()
+    # Pinning needs a slot from the launcher below; with plain `uvicorn main:app` the pool is left unpinned
+    web_workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    slot, slot_lock = None, None
+    if os.getenv("BCRYPT_SLOT_DIR"):
+        slot, slot_lock = claim_worker_slot(os.environ["BCRYPT_SLOT_DIR"], web_workers)
+    app.state.bcrypt_pool = create_bcrypt_pool(web_workers, slot)
+    yield
+    app.state.bcrypt_pool.shutdown()
+    if slot_lock:
+        slot_lock.close()
+    await engine.dispose()
+
+app = FastAPI(
+    title="PyOTP App",
+    description="Simple MFA application",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
+
+# Error bodies are the only JSON the routes return; these mirror FastAPI's default handlers but use orjson
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request: Request, exc: StarletteHTTPException):
+    if not is_body_allowed_for_status_code(exc.status_code):
+        return Response(status_code=exc.status_code, headers=exc.headers)
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers)
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    return ORJSONResponse({"detail": jsonable_encoder(exc.errors())}, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+# Templates (compiled bytecode is shared between workers through a per-user temp directory)
+templates = Jinja2Templates(
+    directory="templates",
+    bytecode_cache=FileSystemBytecodeCache(),
+    auto_reload=False
+)
+
+# Anonymous pages don't depend on the request, so render them once and let clients revalidate by ETag
+def _render_static_page(name: str):
+    body = templates.get_template(name).render().encode()
+    return body, '"' + blake2b(body, digest_size=16).hexdigest() + '"'
 
-# Templates
-templates = Jinja2Templates(directory="templates")
+STATIC_PAGES = {name: _render_static_page(name) for name in ("index.html", "signup.html", "login.html")}
+
+def static_page_response(request: Request, name: str):
+    body, etag = STATIC_PAGES[name]
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=300"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(body, headers=headers)
+
+# bcrypt cost: BCRYPT_ROUNDS, else the value the launcher below calibrated and saved; hashing runs in the pool created by lifespan
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS") or load_bcrypt_rounds() or BCRYPT_MIN_ROUNDS)
+
+# Checked against when the email is unknown, so a miss costs the same bcrypt work as a wrong password
+DUMMY_PASSWORD_HASH = get_password_hash("dummy-password", BCRYPT_ROUNDS)
+
+async def run_bcrypt(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(app.state.bcrypt_pool, func, *args)
 
 # Static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -26,58 +101,70 @@ os.makedirs("static", exist_ok=True)
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    return static_page_response(request, "index.html")
 
 @app.get("/signup", response_class=HTMLResponse)
 async def signup_page(request: Request):
-    return templates.TemplateResponse("signup.html", {"request": request})
+    return static_page_response(request, "signup.html")
 
 @app.post("/signup")
 async def signup(
     email: str = Form(...),
     name: str = Form(...),
     password: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
+    email = normalize_email(email)
+    
     # Check if user already exists
-    existing_user = db.query(User).filter(User.email == email).first()
+    existing_user = await get_user_by_email(db, email)
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
         )
     
-    # Create new user
-    hashed_password = get_password_hash(password)
+    # Create new user (bcrypt is CPU-bound, keep it off the event loop)
+    hashed_password = await run_bcrypt(get_password_hash, password, BCRYPT_ROUNDS)
     user = User(
         email=email,
         name=name,
         hashed_password=hashed_password
     )
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
+    await invalidate_user(email)
     
     return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
 
 @app.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request})
+    return static_page_response(request, "login.html")
 
 @app.post("/login")
 async def login(
     email: str = Form(...),
     password: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Verify user credentials
-    user = db.query(User).filter(User.email == email).first()
-    if not user or not verify_password(password, user.hashed_password):
+    user = await get_user_cached(db, email)
+    hashed_password = user.hashed_password if user else DUMMY_PASSWORD_HASH
+    password_valid = await run_bcrypt(verify_password, password, hashed_password)
+    if not user or not password_valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password"
         )
     
+    # Upgrade older, cheaper hashes so they take as long to check as the dummy one (never downgrade)
+    if password_hash_rounds(user.hashed_password) < BCRYPT_ROUNDS:
+        db_user = await get_user_by_email(db, email)
+        db_user.hashed_password = await run_bcrypt(get_password_hash, password, BCRYPT_ROUNDS)
+        await db.commit()
+        await invalidate_user(email)
+    
     # If MFA is enabled, redirect to MFA verification
     if user.mfa_enabled:
         # Create a temporary token for MFA verification
@@ -101,17 +188,17 @@ async def mfa_verify_page(request: Request, token: str):
 async def mfa_verify(
     code: str = Form(...),
     token: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Verify temporary token
-    email = verify_token(token)
+    email = await verify_token_cached(token)
     if not email:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token"
         )
     
-    user = db.query(User).filter(User.email == email).first()
+    user = await get_user_cached(db, email)
     if not user or not user.mfa_enabled:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -132,49 +219,48 @@ async def mfa_verify(
     return response
 
 @app.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request, db: Session = Depends(get_db)):
+async def dashboard(request: Request, db: AsyncSession = Depends(get_db)):
     # Get token from cookie
     token = request.cookies.get("access_token")
     if not token:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
-    email = verify_token(token)
+    email = await verify_token_cached(token)
     if not email:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
-    user = db.query(User).filter(User.email == email).first()
+    user = await get_user_cached(db, email)
     if not user:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
     return templates.TemplateResponse("dashboard.html", {"request": request, "user": user})
 
 @app.get("/setup-mfa", response_class=HTMLResponse)
-async def setup_mfa_page(request: Request, db: Session = Depends(get_db)):
+async def setup_mfa_page(request: Request, db: AsyncSession = Depends(get_db)):
     # Get token from cookie
     token = request.cookies.get("access_token")
     if not token:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
-    email = verify_token(token)
+    email = await verify_token_cached(token)
     if not email:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
-    user = db.query(User).filter(User.email == email).first()
+    user = await get_user_cached(db, email)
     if not user:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
     if user.mfa_enabled:
         return templates.TemplateResponse("mfa_already_setup.html", {"request": request, "user": user})
     
-    # Generate new MFA secret and QR code
-    secret = generate_mfa_secret()
-    qr_code = generate_qr_code(user.email, secret)
+    # Generate (or reuse the pending) MFA secret and QR code
+    setup = await get_mfa_setup_cached(user.email)
     
     return templates.TemplateResponse("setup_mfa.html", {
         "request": request, 
         "user": user, 
-        "secret": secret, 
-        "qr_code": qr_code
+        "secret": setup.secret, 
+        "qr_code": setup.qr_code
     })
 
 @app.post("/enable-mfa")
@@ -182,47 +268,50 @@ async def enable_mfa(
     request: Request,
     secret: str = Form(...),
     code: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Get token from cookie
     token = request.cookies.get("access_token")
     if not token:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
-    email = verify_token(token)
+    email = await verify_token_cached(token)
     if not email:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
-    user = db.query(User).filter(User.email == email).first()
+    user = await get_user_by_email(db, email)
     if not user:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
-    # Verify the MFA code
-    if not verify_mfa_code(secret, code):
+    # Verify the MFA code against the base32 secret the setup page posted back
+    secret_bytes = decode_mfa_secret(secret)
+    if secret_bytes is None or not verify_mfa_code(secret_bytes, code):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid MFA code"
         )
     
     # Enable MFA for user
-    user.mfa_secret = secret
+    user.mfa_secret = secret_bytes
     user.mfa_enabled = True
-    db.commit()
+    await db.commit()
+    await invalidate_user(email)
+    await clear_mfa_setup(email)
     
     return RedirectResponse(url="/dashboard?mfa_enabled=true", status_code=status.HTTP_303_SEE_OTHER)
 
 @app.get("/disable-mfa", response_class=HTMLResponse)
-async def disable_mfa_page(request: Request, db: Session = Depends(get_db)):
+async def disable_mfa_page(request: Request, db: AsyncSession = Depends(get_db)):
     # Get token from cookie
     token = request.cookies.get("access_token")
     if not token:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
-    email = verify_token(token)
+    email = await verify_token_cached(token)
     if not email:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
-    user = db.query(User).filter(User.email == email).first()
+    user = await get_user_cached(db, email)
     if not user:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
@@ -235,18 +324,18 @@ async def disable_mfa_page(request: Request, db: Session = Depends(get_db)):
 async def disable_mfa(
     request: Request,
     code: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Get token from cookie
     token = request.cookies.get("access_token")
     if not token:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
-    email = verify_token(token)
+    email = await verify_token_cached(token)
     if not email:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
-    user = db.query(User).filter(User.email == email).first()
+    user = await get_user_by_email(db, email)
     if not user:
         return RedirectResponse(url="/login", status_code=status.HTTP_303_SEE_OTHER)
     
@@ -263,7 +352,8 @@ async def disable_mfa(
     # Disable MFA for user
     user.mfa_secret = None
     user.mfa_enabled = False
-    db.commit()
+    await db.commit()
+    await invalidate_user(email)
     
     return RedirectResponse(url="/dashboard?mfa_disabled=true", status_code=status.HTTP_303_SEE_OTHER)
 
@@ -275,4 +365,31 @@ async def logout():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Calibrate on the first launch only and reuse the saved cost afterwards, so it stays stable
+    if "BCRYPT_ROUNDS" not in os.environ:
+        rounds = load_bcrypt_rounds()
+        if rounds is None:
+            rounds = calibrate_bcrypt_rounds()
+            save_bcrypt_rounds(rounds)
+        os.environ["BCRYPT_ROUNDS"] = str(rounds)
+    # Exported so each worker's bcrypt pool and database pool take only their share
+    os.environ.setdefault("WEB_CONCURRENCY", str(os.cpu_count() or 1))
+    
+    # Create the schema once here instead of in every worker
+    async def create_schema():
+        await init_db()
+        await engine.dispose()
+    asyncio.run(create_schema())
+    os.environ["DB_SCHEMA_READY"] = "1"
+    # Workers lock slot files here to get their own run of CPUs for bcrypt pinning
+    with tempfile.TemporaryDirectory() as slot_dir:
+        os.environ["BCRYPT_SLOT_DIR"] = slot_dir
+        # Workers need an import string rather than the app object; uvloop and httptools are the C event loop and parser
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=int(os.environ["WEB_CONCURRENCY"]),
+            loop="uvloop",
+            http="httptools"
+        )
@@ -1,5 +1,6 @@
 from pydantic import BaseModel, EmailStr
 from typing import Optional
+from datetime import datetime
 
 class UserCreate(BaseModel):
     email: str
@@ -23,6 +24,20 @@ class UserResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class CachedUser(BaseModel):
+    id: int
+    email: str
+    name: str
+    hashed_password: str
+    mfa_secret: Optional[bytes] = None
+    mfa_enabled: bool
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+        ser_json_bytes = "base64"
+        val_json_bytes = "base64"
+
 class Token(BaseModel):
     access_token: str
     token_type: str